@@ -1,9 +1,30 @@
 import os
+import sys
+import argparse
+import atexit
+import hashlib
 import logging
+import sched
+import signal
+import tempfile
 import time
+import threading
+import orjson
 import requests
-from typing import Dict, Optional, List, Set
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, FrozenSet, Iterator, Mapping, Optional, Set, Tuple
+from dataclasses import dataclass
 from datetime import datetime
+from types import MappingProxyType
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -12,28 +33,191 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Конфигурация из переменных окружения
-NOTION_TOKEN = os.getenv("NOTION_TOKEN")
-DATABASE_ID = os.getenv("DATABASE_ID")
-UPDATE_FREQUENCY = int(os.getenv("UPDATE_FREQUENCY", "2"))
+def _env_number(name: str, default: str, cast):
+    """Чтение числовой переменной окружения с понятной ошибкой"""
+    raw = os.getenv(name, default)
+    try:
+        return cast(raw)
+    except ValueError:
+        raise ValueError(f"{name} должен быть числом, получено: {raw!r}")
 
-# Проверка обязательных переменных
-if not NOTION_TOKEN:
-    logger.error("NOTION_TOKEN не установлен в переменных окружения")
-    exit(1)
-if not DATABASE_ID:
-    logger.error("DATABASE_ID не установлен в переменных окружения")
+@dataclass(frozen=True)
+class Config:
+    """Конфигурация из переменных окружения, загружается один раз при старте"""
+    notion_token: str
+    database_id: str
+    update_frequency: int
+    notion_max_workers: int
+    notion_rate_limit: float
+    rates_cache_file: str
+    run_mode: str
+    
+    @classmethod
+    def from_env(cls) -> "Config":
+        """
+        Загрузка и проверка конфигурации
+        
+        Raises:
+            ValueError: если переменная не задана или имеет недопустимое значение
+        """
+        notion_token = os.getenv("NOTION_TOKEN", "").strip()
+        if not notion_token:
+            raise ValueError("NOTION_TOKEN не установлен в переменных окружения")
+        
+        database_id = os.getenv("DATABASE_ID", "").strip()
+        if not database_id:
+            raise ValueError("DATABASE_ID не установлен в переменных окружения")
+        
+        update_frequency = _env_number("UPDATE_FREQUENCY", "2", int)
+        if update_frequency < 1:
+            raise ValueError("UPDATE_FREQUENCY должен быть не меньше 1")
+        
+        notion_max_workers = _env_number("NOTION_MAX_WORKERS", "8", int)
+        if notion_max_workers < 1:
+            raise ValueError("NOTION_MAX_WORKERS должен быть не меньше 1")
+        
+        notion_rate_limit = _env_number("NOTION_RATE_LIMIT", "3", float)
+        if notion_rate_limit <= 0:
+            raise ValueError("NOTION_RATE_LIMIT должен быть больше 0")
+        
+        # По умолчанию кэш лежит в личном каталоге пользователя: в общем /tmp
+        # другой пользователь мог бы подложить свой файл с курсами
+        cache_home = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        rates_cache_file = os.getenv("RATES_CACHE_FILE") or os.path.join(cache_home, "currency-updater", "byn_rates.json")
+        
+        run_mode = os.getenv("RUN_MODE", "loop").strip().lower()
+        if run_mode not in ("loop", "oneshot"):
+            raise ValueError(f"RUN_MODE должен быть loop или oneshot, получено: {run_mode!r}")
+        
+        return cls(
+            notion_token=notion_token,
+            database_id=database_id,
+            update_frequency=update_frequency,
+            notion_max_workers=notion_max_workers,
+            notion_rate_limit=notion_rate_limit,
+            rates_cache_file=rates_cache_file,
+            run_mode=run_mode,
+        )
+
+# Конфигурация из переменных окружения
+try:
+    CONFIG = Config.from_env()
+except ValueError as e:
+    logger.error(str(e))
     exit(1)
 
 # Константы для Notion API
 NOTION_API_VERSION = "2022-06-28"
 NOTION_API_BASE_URL = "https://api.notion.com/v1"
 HEADERS = {
-    "Authorization": f"Bearer {NOTION_TOKEN}",
+    "Authorization": f"Bearer {CONFIG.notion_token}",
     "Notion-Version": NOTION_API_VERSION,
     "Content-Type": "application/json"
 }
 
+def _create_session(
+    headers: Optional[Dict[str, str]] = None,
+    pool_maxsize: int = 4,
+    status_forcelist: Tuple[int, ...] = (429, 500, 502, 503, 504),
+    allowed_methods: FrozenSet[str] = frozenset(["GET"]),
+) -> requests.Session:
+    """Создание HTTP-сессии с пулом keep-alive соединений и повторами"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=status_forcelist,
+            allowed_methods=allowed_methods,
+        )
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+def _create_notion_session() -> requests.Session:
+    """
+    Сессия для Notion API
+    
+    Токен и Content-Type задаются в заголовках сессии один раз. Пул рассчитан
+    на все потоки обновления. Запрос к базе и PATCH курса можно безопасно
+    повторять, поэтому 5xx повторяются для всех методов. 429 обрабатывает
+    OptimizedNotionUpdater._notion_request, чтобы пауза передалась лимитеру
+    """
+    return _create_session(
+        HEADERS,
+        pool_maxsize=CONFIG.notion_max_workers,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST", "PATCH"]),
+    )
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: пополняется на rate токенов в секунду,
+    хранит не более capacity токенов для коротких всплесков
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._penalties = 0
+        self._lock = threading.Lock()
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def acquire(self):
+        """Забирает токен, ожидая его появления при необходимости"""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                self._tokens -= 1
+                # Отрицательный запас означает очередь: ждём вне блокировки,
+                # чтобы остальные потоки могли занять следующие слоты
+                wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+                penalties = self._penalties
+            
+            if wait > 0:
+                time.sleep(wait)
+            
+            # Если пока поток ждал, пришёл 429, занятый до паузы слот устарел:
+            # встаём в очередь заново, уже после паузы
+            with self._lock:
+                if self._penalties == penalties:
+                    return
+    
+    def penalize(self, delay: float):
+        """Приостанавливает выдачу токенов на delay секунд (например, по Retry-After)"""
+        with self._lock:
+            self._refill(time.monotonic())
+            # Ожидающие потоки займут слоты заново, поэтому их очередь сбрасывается
+            self._tokens = -delay * self.rate
+            self._penalties += 1
+
+def _retry_after_seconds(response: requests.Response, default: float) -> float:
+    """Значение заголовка Retry-After в секундах или default, если его нет"""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", default)))
+    except (TypeError, ValueError):
+        return default
+
+# Число попыток запроса к Notion при ответе 429 и базовая пауза
+# экспоненциальной задержки, если Notion не прислал Retry-After:
+# между четырьмя попытками паузы 0.5, 1 и 2 с
+NOTION_MAX_ATTEMPTS = 4
+NOTION_BACKOFF_BASE = 0.5
+
+# Тело PATCH для обновления курса: меняется только число, поэтому JSON
+# не собирается заново на каждую запись. repr(float) даёт валидное число JSON
+_PATCH_TEMPLATE = b'{"properties":{"Money_rate":{"number":%s}}}'
+
 # Соответствие числовых кодов из поля Notion к буквенным кодам валют
 CURRENCY_CODE_MAPPING = {
     145: "USD",  # Доллар США
@@ -43,26 +227,117 @@ CURRENCY_CODE_MAPPING = {
     293: "GBP",  # Фунт стерлингов
     304: "CNY",  # Китайский юань
 }
+# Плотная таблица код → валюта: индексирование списка дешевле поиска в словаре
+_CCM_SIZE = max(CURRENCY_CODE_MAPPING) + 1
+_CCM = [None] * _CCM_SIZE
+for _code, _currency in CURRENCY_CODE_MAPPING.items():
+    _CCM[_code] = _currency
+del _code, _currency
+KNOWN_CURRENCIES = frozenset(CURRENCY_CODE_MAPPING.values())
+
+# Поля ответа API Беларусбанка (курс покупки) и соответствующие коды валют
+_BANK_FIELD_TO_OUR = {
+    'USD_in': 'USD',
+    'EUR_in': 'EUR',
+    'RUB_in': 'RUB',
+    'GBP_in': 'GBP',
+    'CNY_in': 'CNY',
+    'PLN_in': 'PLN',
+    'UAH_in': 'UAH',
+}
+_BANK_FIELDS = tuple(_BANK_FIELD_TO_OUR.items())
+
+# Фиксированные курсы на случай недоступности API
+_FIXED_RATES = {
+    'USD': 3.15,
+    'EUR': 3.40,
+    'RUB': 0.034,
+    'GBP': 4.00,
+    'CNY': 0.43,
+}
+
+# Курсы, отличающиеся меньше чем на это значение, считаются равными
+RATE_TOLERANCE = 1e-6
+
+def _from_number(field: Dict) -> Optional[str]:
+    """Код валюты из поля ID_money типа number"""
+    number_value = field.get("number")
+    if number_value is None:
+        return None
+    if not isinstance(number_value, int):
+        number_value = int(number_value)
+    return _CCM[number_value] if 0 <= number_value < _CCM_SIZE else None
+
+# Обработчики значения ID_money по типу поля
+_EXTRACTORS = {
+    "number": _from_number,
+}
+
+@contextmanager
+def _cache_file_lock(path: str):
+    """
+    Межпроцессная блокировка обновления файлового кэша
+    
+    Там, где нет fcntl (Windows) или файл блокировки недоступен,
+    работает без блокировки
+    """
+    lock_file = None
+    if fcntl is not None:
+        try:
+            lock_file = open(f"{path}.lock", "a")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except OSError as e:
+            logger.warning(f"Не удалось заблокировать файловый кэш курсов: {e}")
+            if lock_file is not None:
+                lock_file.close()
+                lock_file = None
+    try:
+        yield
+    finally:
+        # Закрытие файла снимает блокировку
+        if lock_file is not None:
+            lock_file.close()
 
 class CurrencyParser:
     """Оптимизированный парсер курсов валют"""
     
-    def __init__(self):
+    def __init__(self, session: Optional[requests.Session] = None):
+        # Отдельная от Notion сессия: токен Notion не должен уходить в Беларусбанк
+        self._session = session or _create_session()
         self.rates_cache = {}
+        # Неизменяемое представление кэша, которое отдаётся вызывающему коду
+        # без копирования; пересоздаётся только при замене кэша
+        self._rates_view = MappingProxyType(self.rates_cache)
         self.cache_timestamp = None
         self.cache_valid_hours = 1
+        # Валидаторы последнего ответа Беларусбанка для условных запросов
+        self._bb_etag = None
+        self._bb_last_mod = None
+        # Хэш тела последнего ответа: на случай, если сервер не поддерживает
+        # условные запросы и отвечает 200 с теми же данными
+        self._bb_digest = None
+        # Валюты, для которых последний вызов get_exchange_rates_batch
+        # взял фиксированный курс вместо курса банка
+        self._fixed_codes: FrozenSet[str] = frozenset()
+        try:
+            os.makedirs(os.path.dirname(CONFIG.rates_cache_file) or ".", mode=0o700, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Не удалось создать каталог файлового кэша курсов: {e}")
+        self._load_disk_cache()
     
-    def get_exchange_rates_batch(self, currency_codes: Set[str]) -> Dict[str, float]:
+    def get_exchange_rates_batch(self, currency_codes: Set[str], warn_fixed: bool = True) -> Dict[str, float]:
         """
         Получение курсов для нескольких валют одной пачкой
         
         Args:
             currency_codes: множество кодов валют
+            warn_fixed: предупреждать о валютах, для которых взят фиксированный курс
             
         Returns:
             Словарь {код_валюты: курс}
         """
         result = {}
+        fixed_codes = set()
         
         # Всегда добавляем BYN
         if 'BYN' in currency_codes:
@@ -83,54 +358,35 @@ class CurrencyParser:
                 fixed_rate = self._get_fixed_rate(code)
                 if fixed_rate is not None:
                     result[code] = fixed_rate
-                    logger.warning(f"Используется фиксированный курс для {code}: {fixed_rate}")
+                    fixed_codes.add(code)
+        
+        self._fixed_codes = frozenset(fixed_codes)
+        if warn_fixed:
+            self.warn_fixed_rates(fixed_codes)
         
         return result
     
-    def _get_belarusbank_rates(self) -> Dict[str, float]:
+    def warn_fixed_rates(self, currency_codes: Set[str]):
+        """
+        Предупреждение о валютах из currency_codes, для которых последний
+        вызов get_exchange_rates_batch взял фиксированный курс
+        """
+        for code in sorted(self._fixed_codes.intersection(currency_codes)):
+            logger.warning("Используется фиксированный курс для %s: %s", code, self._get_fixed_rate(code))
+    
+    def _get_belarusbank_rates(self) -> Mapping[str, float]:
         """Получение всех курсов от API Беларусбанка одним запросом"""
         try:
             # Проверяем кэш
             if self._should_refresh_cache():
-                logger.info("Загрузка курсов с Беларусбанка...")
-                
-                url = "https://belarusbank.by/api/kursExchange"
-                response = requests.get(url, params={"city": "Минск"}, timeout=15)
-                response.raise_for_status()
-                
-                data = response.json()
-                
-                if not data or not isinstance(data, list):
-                    logger.error("Неверный формат ответа от Беларусбанка")
-                    return {}
-                
-                # Маппинг кодов валют на поля в ответе API
-                bank_field_mapping = {
-                    'USD': 'USD_in',
-                    'EUR': 'EUR_in',
-                    'RUB': 'RUB_in',
-                    'GBP': 'GBP_in',
-                    'CNY': 'CNY_in',
-                    'PLN': 'PLN_in',
-                    'UAH': 'UAH_in',
-                }
-                
-                # Очищаем и заполняем кэш
-                self.rates_cache = {}
-                bank_data = data[0]
-                
-                for our_code, bank_field in bank_field_mapping.items():
-                    if bank_field in bank_data and bank_data[bank_field]:
-                        try:
-                            rate = float(bank_data[bank_field])
-                            self.rates_cache[our_code] = rate
-                        except (ValueError, TypeError):
-                            logger.warning(f"Не удалось преобразовать курс для {our_code}")
-                
-                self.cache_timestamp = time.time()
-                logger.info(f"Загружено {len(self.rates_cache)} курсов с Беларусбанка")
+                # Блокировка не даёт нескольким процессам одновременно обращаться к API
+                with _cache_file_lock(CONFIG.rates_cache_file):
+                    # Пока ждали блокировку, кэш на диске мог обновить другой процесс
+                    self._load_disk_cache()
+                    if self._should_refresh_cache() and not self._fetch_belarusbank_rates():
+                        return {}
             
-            return self.rates_cache.copy()
+            return self._rates_view
             
         except requests.exceptions.Timeout:
             logger.error("Таймаут при запросе к API Беларусбанка")
@@ -139,16 +395,143 @@ class CurrencyParser:
             logger.error(f"Ошибка загрузки курсов: {e}")
             return {}
     
+    def _fetch_belarusbank_rates(self) -> bool:
+        """Загрузка курсов с API Беларусбанка в кэш; False при неверном ответе"""
+        logger.info("Загрузка курсов с Беларусбанка...")
+        
+        url = "https://belarusbank.by/api/kursExchange"
+        response = self._session.get(
+            url, params={"city": "Минск"}, headers=self._conditional_headers(), timeout=15
+        )
+        
+        if response.status_code == 304:
+            # Курсы не изменились: продлеваем кэш без разбора ответа
+            self.cache_timestamp = time.time()
+            logger.info("Курсы Беларусбанка не изменились (304), используется кэш")
+            self._save_disk_cache()
+            return True
+        
+        response.raise_for_status()
+        
+        digest = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+        if digest == self._bb_digest and self.rates_cache:
+            # Тело ответа совпадает с прошлым: курсы не изменились
+            self.cache_timestamp = time.time()
+            logger.info("Курсы Беларусбанка не изменились, используется кэш")
+            self._save_disk_cache()
+            return True
+        
+        data = orjson.loads(response.content)
+        
+        if not data or not isinstance(data, list):
+            logger.error("Неверный формат ответа от Беларусбанка")
+            return False
+        
+        # Собираем курсы в локальный словарь и подменяем кэш целиком
+        bank_data = data[0]
+        rates = {}
+        invalid_codes = []
+        
+        for bank_field, our_code in _BANK_FIELDS:
+            value = bank_data.get(bank_field)
+            if not value:
+                continue
+            try:
+                rates[our_code] = float(value)
+            except (ValueError, TypeError):
+                invalid_codes.append(our_code)
+        
+        if invalid_codes:
+            logger.warning("Не удалось преобразовать курсы для %s", ", ".join(invalid_codes))
+        
+        self._set_rates(rates)
+        self.cache_timestamp = time.time()
+        self._bb_etag = response.headers.get("ETag")
+        self._bb_last_mod = response.headers.get("Last-Modified")
+        self._bb_digest = digest
+        logger.info(f"Загружено {len(self.rates_cache)} курсов с Беларусбанка")
+        self._save_disk_cache()
+        return True
+    
     def _get_fixed_rate(self, currency_code: str) -> Optional[float]:
         """Фиксированные курсы на случай недоступности API"""
-        fixed_rates = {
-            'USD': 3.15,
-            'EUR': 3.40,
-            'RUB': 0.034,
-            'GBP': 4.00,
-            'CNY': 0.43,
-        }
-        return fixed_rates.get(currency_code)
+        return _FIXED_RATES.get(currency_code)
+    
+    def _set_rates(self, rates: Dict[str, float]):
+        """Замена кэша курсов вместе с его представлением"""
+        self.rates_cache = rates
+        self._rates_view = MappingProxyType(rates)
+    
+    def _conditional_headers(self) -> Dict[str, str]:
+        """Заголовки условного запроса по сохранённым ETag/Last-Modified"""
+        headers = {}
+        # Ответ 304 полезен только если есть курсы, которые можно переиспользовать
+        if not self.rates_cache:
+            return headers
+        if self._bb_etag:
+            headers["If-None-Match"] = self._bb_etag
+        if self._bb_last_mod:
+            headers["If-Modified-Since"] = self._bb_last_mod
+        return headers
+    
+    def _load_disk_cache(self):
+        """Загрузка курсов из файлового кэша, если он ещё не устарел"""
+        try:
+            with open(CONFIG.rates_cache_file, "rb") as f:
+                payload = orjson.loads(f.read())
+            
+            timestamp = float(payload["ts"])
+            rates = {code: float(rate) for code, rate in payload["rates"].items()}
+            etag = payload.get("etag")
+            last_mod = payload.get("last_modified")
+            digest = payload.get("digest")
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать файловый кэш курсов: {e}")
+            return
+        
+        if (time.time() - timestamp) < (self.cache_valid_hours * 3600):
+            self._set_rates(rates)
+            self.cache_timestamp = timestamp
+            self._bb_etag = etag
+            self._bb_last_mod = last_mod
+            self._bb_digest = digest
+            logger.info(f"Загружено {len(rates)} курсов из файлового кэша {CONFIG.rates_cache_file}")
+    
+    def _save_disk_cache(self):
+        """Атомарная запись курсов в файловый кэш"""
+        cache_file = CONFIG.rates_cache_file
+        tmp_path = None
+        try:
+            # mkstemp создаёт новый файл с уникальным именем и правами 0600,
+            # не следуя подложенным символическим ссылкам
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(cache_file) or ".",
+                prefix=f"{os.path.basename(cache_file)}.",
+                suffix=".tmp",
+            )
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps({
+                    "ts": self.cache_timestamp,
+                    "rates": self.rates_cache,
+                    "etag": self._bb_etag,
+                    "last_modified": self._bb_last_mod,
+                    "digest": self._bb_digest,
+                }))
+            # os.replace атомарен, поэтому читатели не увидят недописанный файл
+            os.replace(tmp_path, cache_file)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить файловый кэш курсов: {e}")
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+    
+    def close(self):
+        """Закрытие HTTP-сессии"""
+        self._session.close()
     
     def _should_refresh_cache(self) -> bool:
         """Проверяет, нужно ли обновить кэш"""
@@ -160,195 +543,365 @@ class OptimizedNotionUpdater:
     """Оптимизированный класс для работы с Notion API"""
     
     def __init__(self):
+        self._session = _create_notion_session()
+        # Общий для всех потоков лимитер. Средняя частота не превышает
+        # NOTION_RATE_LIMIT, но полный запас (равный секундному лимиту) плюс
+        # пополнение пропускают в первую секунду до 2×NOTION_RATE_LIMIT
+        # запросов. Notion ограничивает среднюю частоту и допускает такие всплески
+        self._limiter = TokenBucket(rate=CONFIG.notion_rate_limit, capacity=CONFIG.notion_rate_limit)
         self.parser = CurrencyParser()
+        # Тип поля ID_money и его обработчик, определённые по схеме базы.
+        # Пока схема не прочитана, тип определяется по каждой записи
+        self._id_money_type = "number"
+        self._extract = None
+        # Строка запроса filter_properties: Notion вернёт в записях только
+        # ID_money и Money_rate вместо всех свойств
+        self._properties_query = ""
+        # Признак того, что последний обход базы прервался из-за ошибки
+        self._query_failed = False
+    
+    def close(self):
+        """Закрытие HTTP-сессий Notion и парсера курсов"""
+        self._session.close()
+        self.parser.close()
+    
+    def _notion_request(self, method: str, url: str, body: Optional[bytes] = None) -> requests.Response:
+        """
+        Запрос к Notion API через общий лимитер с повтором при 429
+        
+        Retry-After передаётся в лимитер, поэтому паузу выдерживают все потоки,
+        а не только получивший 429. Без Retry-After пауза растёт экспоненциально
+        (0.5, 1, 2 с). Ответ последней попытки возвращается как есть
+        """
+        for attempt in range(1, NOTION_MAX_ATTEMPTS + 1):
+            self._limiter.acquire()
+            response = self._session.request(method, url, data=body, timeout=30)
+            if response.status_code != 429 or attempt == NOTION_MAX_ATTEMPTS:
+                return response
+            
+            retry_after = _retry_after_seconds(response, NOTION_BACKOFF_BASE * 2 ** (attempt - 1))
+            self._limiter.penalize(retry_after)
+            logger.warning(
+                "Превышен лимит Notion API (%s %s), попытка %d из %d, пауза %.1fс",
+                method, url, attempt, NOTION_MAX_ATTEMPTS, retry_after
+            )
+        return response
     
-    def get_all_database_entries(self) -> List[Dict]:
-        """Получение всех записей из базы данных одним запросом с пагинацией"""
+    def detect_schema(self):
+        """Определение типа поля ID_money по схеме базы данных (один запрос)"""
         try:
-            logger.info(f"Получение всех записей из базы данных {DATABASE_ID}")
+            url = f"{NOTION_API_BASE_URL}/databases/{CONFIG.database_id}"
+            response = self._notion_request("GET", url)
+            response.raise_for_status()
+            properties = orjson.loads(response.content).get("properties", {})
             
-            url = f"{NOTION_API_BASE_URL}/databases/{DATABASE_ID}/query"
-            all_pages = []
+            field_type = properties["ID_money"]["type"]
+        except KeyError:
+            logger.warning("Поле ID_money не найдено в схеме базы данных")
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось получить схему базы данных: {e}")
+            return
+        
+        self._id_money_type = field_type
+        self._extract = _EXTRACTORS.get(field_type)
+        
+        # ID свойств уже URL-кодированы Notion, поэтому строка собирается
+        # вручную: при передаче через params= они были бы закодированы повторно
+        property_ids = [properties[name].get("id") for name in ("ID_money", "Money_rate") if name in properties]
+        if all(property_ids):
+            self._properties_query = "?" + "&".join(f"filter_properties={pid}" for pid in property_ids)
+
+        if self._extract is None:
+            logger.warning(f"Тип поля ID_money не поддерживается: {field_type}")
+        else:
+            logger.info(f"Тип поля ID_money: {field_type}")
+    
+    def iter_database_entries(self) -> Iterator[Dict]:
+        """
+        Потоковое получение записей из базы данных с пагинацией
+        
+        Записи отдаются по мере загрузки страниц ответа, поэтому в памяти
+        одновременно находится не более одной страницы (100 записей).
+        Если обход прервался из-за ошибки, выставляется _query_failed
+        """
+        self._query_failed = False
+        try:
+            database_id = CONFIG.database_id
+            logger.info(f"Получение всех записей из базы данных {database_id}")
+            
+            url = f"{NOTION_API_BASE_URL}/databases/{database_id}/query{self._properties_query}"
+            total = 0
             has_more = True
             next_cursor = None
             
             while has_more:
-                payload = {"page_size": 100}
+                # Запрашиваем только записи с заполненным ID_money,
+                # остальные всё равно были бы пропущены
+                payload = {
+                    "page_size": 100,
+                    "filter": {"property": "ID_money", self._id_money_type: {"is_not_empty": True}}
+                }
                 if next_cursor:
                     payload["start_cursor"] = next_cursor
                 
-                response = requests.post(url, headers=HEADERS, json=payload, timeout=30)
+                response = self._notion_request("POST", url, orjson.dumps(payload))
                 response.raise_for_status()
-                data = response.json()
+                data = orjson.loads(response.content)
                 
-                all_pages.extend(data.get("results", []))
-                has_more = data.get("has_more", False)
-                next_cursor = data.get("next_cursor")
+                # Notion всегда возвращает эти ключи в ответе на запрос к базе;
+                # их отсутствие означает неожиданный ответ и прерывает обход
+                results = data["results"]
+                has_more = data["has_more"]
+                next_cursor = data["next_cursor"]
+                
+                total += len(results)
+                yield from results
             
-            logger.info(f"Найдено {len(all_pages)} записей")
-            return all_pages
+            logger.info(f"Найдено {total} записей")
             
+        except KeyError as e:
+            logger.error(f"Неверный формат ответа Notion: нет ключа {e}")
+            self._query_failed = True
         except Exception as e:
             logger.error(f"Ошибка получения данных: {e}")
-            return []
+            self._query_failed = True
     
     def extract_currency_code(self, page_properties: Dict) -> Optional[str]:
         """Извлечение кода валюты из свойств страницы"""
-        try:
-            id_money_field = page_properties.get("ID_money")
-            if not id_money_field:
-                return None
-            
-            field_type = id_money_field.get("type")
-            
-            if field_type == "number":
-                number_value = id_money_field.get("number")
-                if number_value is not None:
-                    return CURRENCY_CODE_MAPPING.get(int(number_value))
-            
-            return None
-        except Exception:
+        id_money_field = page_properties.get("ID_money")
+        if not id_money_field:
             return None
+        
+        # Схема общая для всех записей, поэтому обработчик обычно выбран заранее.
+        # Обработчики не бросают исключений на значениях из JSON, поэтому
+        # try/except на каждую запись не нужен
+        extract = self._extract or _EXTRACTORS.get(id_money_field.get("type"))
+        return extract(id_money_field) if extract else None
     
     def process_database_optimized(self) -> Dict:
         """
         Оптимизированная обработка базы данных:
-        1. Собираем все уникальные валюты
-        2. Одним запросом получаем все курсы
-        3. Обновляем все записи
+        1. Одним запросом получаем курсы всех известных валют
+        2. Читаем записи постранично
+        3. Обновление каждой записи ставим в очередь сразу, параллельно
+           с загрузкой следующих страниц
         """
-        # Шаг 1: Получаем все записи
-        pages = self.get_all_database_entries()
-        if not pages:
-            return {"updated": 0, "skipped": 0, "errors": 0}
-        
-        # Шаг 2: Собираем информацию о всех записях и уникальные валюты
-        page_data = []  # Будет хранить (page_id, currency_code)
-        unique_currencies = set()
-        
-        for page in pages:
-            page_id = page["id"]
-            properties = page.get("properties", {})
-            
-            currency_code = self.extract_currency_code(properties)
-            if not currency_code:
-                logger.debug(f"Пропуск записи {page_id}: не удалось определить валюту")
-                continue
-            
-            page_data.append((page_id, currency_code))
-            unique_currencies.add(currency_code)
-        
-        logger.info(f"Найдено {len(unique_currencies)} уникальных валют: {', '.join(sorted(unique_currencies))}")
-        
-        # Шаг 3: Получаем курсы для всех уникальных валют одной пачкой
-        if not unique_currencies:
-            logger.warning("Нет валют для обработки")
-            return {"updated": 0, "skipped": 0, "errors": 0}
+        if self._extract is None:
+            self.detect_schema()
         
+        # Шаг 1: Все курсы приходят одним ответом Беларусбанка, поэтому их можно
+        # получить до чтения записей и не ждать окончания пагинации. О фиксированных
+        # курсах предупреждаем позже, только для валют, которые есть в базе
         start_time = time.time()
-        exchange_rates = self.parser.get_exchange_rates_batch(unique_currencies)
-        logger.info(f"Получено курсов: {len(exchange_rates)} из {len(unique_currencies)} за {time.time()-start_time:.2f}с")
+        exchange_rates = self.parser.get_exchange_rates_batch(KNOWN_CURRENCIES, warn_fixed=False)
+        logger.info(f"Курсы получены за {time.time()-start_time:.2f}с")
         
-        # Шаг 4: Обновляем записи
+        total_pages = 0
+        matched_count = 0
         updated_count = 0
+        unchanged_count = 0
         error_count = 0
+        unique_currencies = set()
+        missing_rates: Dict[str, int] = defaultdict(int)  # {код_валюты: число записей}
+        futures = {}  # {future: (page_id, currency_code, rate)}
         
-        for page_id, currency_code in page_data:
-            try:
-                if currency_code not in exchange_rates:
-                    logger.warning(f"Нет курса для валюты {currency_code} (запись {page_id})")
-                    error_count += 1
+        # Частоту запросов ограничивает общий лимитер в _notion_request
+        executor = ThreadPoolExecutor(max_workers=CONFIG.notion_max_workers)
+        try:
+            # Шаг 2: Читаем записи и сразу отправляем обновления в пул потоков,
+            # пока загружаются следующие страницы. Методы, вызываемые на каждую
+            # запись, привязаны к локальным именам
+            debug_enabled = logger.isEnabledFor(logging.DEBUG)
+            extract_currency_code = self.extract_currency_code
+            add_currency = unique_currencies.add
+            get_rate = exchange_rates.get
+            submit = executor.submit
+            update_page = self._update_single_page
+            
+            for page in self.iter_database_entries():
+                total_pages += 1
+                page_id = page["id"]
+                properties = page.get("properties", {})
+                
+                currency_code = extract_currency_code(properties)
+                if not currency_code:
+                    if debug_enabled:
+                        logger.debug("Пропуск записи %s: не удалось определить валюту", page_id)
                     continue
                 
-                rate = exchange_rates[currency_code]
+                matched_count += 1
+                add_currency(currency_code)
                 
-                # Обновляем запись в Notion
-                if self._update_single_page(page_id, rate):
-                    updated_count += 1
-                    logger.debug(f"Обновлен курс {currency_code} = {rate} для записи {page_id}")
-                else:
-                    error_count += 1
+                rate = get_rate(currency_code)
+                if rate is None:
+                    missing_rates[currency_code] += 1
+                    continue
                 
-                # Минимальная задержка между запросами к Notion API
-                time.sleep(0.05)
+                # Текущее значение уже есть в ответе запроса, отдельно его не читаем
+                existing_rate = properties.get("Money_rate", {}).get("number")
+                if existing_rate is not None and abs(existing_rate - rate) < RATE_TOLERANCE:
+                    unchanged_count += 1
+                    if debug_enabled:
+                        logger.debug("Курс %s в записи %s не изменился", currency_code, page_id)
+                    continue
                 
-            except Exception as e:
-                logger.error(f"Ошибка обработки записи {page_id}: {e}")
-                error_count += 1
+                futures[submit(update_page, page_id, rate)] = (page_id, currency_code, rate)
+            
+            if unique_currencies:
+                logger.info(f"Найдено {len(unique_currencies)} уникальных валют: {', '.join(sorted(unique_currencies))}")
+                found_rates = unique_currencies & exchange_rates.keys()
+                logger.info(f"Получено курсов: {len(found_rates)} из {len(unique_currencies)}")
+                self.parser.warn_fixed_rates(found_rates)
+            elif total_pages:
+                logger.warning("Нет валют для обработки")
+            
+            for currency_code, count in missing_rates.items():
+                logger.warning("Нет курса для валюты %s (%d записей)", currency_code, count)
+                error_count += count
+            
+            # Шаг 3: Собираем результаты обновлений
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        updated_count += 1
+                        if debug_enabled:
+                            page_id, currency_code, rate = futures[future]
+                            logger.debug("Обновлен курс %s = %s для записи %s", currency_code, rate, page_id)
+                    else:
+                        error_count += 1
+                except Exception as e:
+                    logger.error("Ошибка обработки записи %s: %s", futures[future][0], e)
+                    error_count += 1
+        finally:
+            # При прерывании (SIGTERM, Ctrl+C) не ждём выполнения очереди
+            executor.shutdown(wait=True, cancel_futures=True)
         
         return {
             "updated": updated_count,
-            "skipped": len(pages) - len(page_data),
+            "unchanged": unchanged_count,
+            "skipped": total_pages - matched_count,
             "errors": error_count,
             "unique_currencies": len(unique_currencies),
-            "api_calls_saved": len(page_data) - len(unique_currencies)  # Сэкономленные запросы
+            "query_failed": self._query_failed,
+            "api_calls_saved": matched_count - len(unique_currencies)  # Сэкономленные запросы
         }
     
     def _update_single_page(self, page_id: str, rate: float) -> bool:
         """Обновление одной страницы в Notion"""
         try:
             url = f"{NOTION_API_BASE_URL}/pages/{page_id}"
-            payload = {
-                "properties": {
-                    "Money_rate": {"number": rate}
-                }
-            }
+            body = _PATCH_TEMPLATE % repr(float(rate)).encode()
             
-            response = requests.patch(url, headers=HEADERS, json=payload, timeout=30)
+            response = self._notion_request("PATCH", url, body)
             response.raise_for_status()
             return True
             
         except Exception as e:
-            logger.error(f"Ошибка обновления {page_id}: {e}")
+            logger.error("Ошибка обновления %s: %s", page_id, e)
             return False
 
+def _handle_sigterm(signum, frame):
+    """Немедленное завершение по SIGTERM, не дожидаясь окончания сна"""
+    logger.info("Получен SIGTERM. Завершение работы.")
+    sys.exit(0)
+
+def run_update(updater: OptimizedNotionUpdater) -> Dict:
+    """Один проход обновления с логированием результатов"""
+    start_time = time.time()
+    
+    # Запускаем оптимизированную обработку
+    result = updater.process_database_optimized()
+    
+    execution_time = time.time() - start_time
+    
+    # Логируем результаты
+    logger.info("=" * 40)
+    logger.info("РЕЗУЛЬТАТЫ ОБРАБОТКИ:")
+    logger.info(f"  Уникальных валют: {result['unique_currencies']}")
+    logger.info(f"  Обновлено записей: {result['updated']}")
+    logger.info(f"  Без изменений: {result['unchanged']}")
+    logger.info(f"  Пропущено записей: {result['skipped']}")
+    logger.info(f"  Ошибок: {result['errors']}")
+    if result['query_failed']:
+        logger.info("  Обход базы данных прерван из-за ошибки")
+    logger.info(f"  Сэкономлено запросов к API: {result['api_calls_saved']}")
+    logger.info(f"  Время выполнения: {execution_time:.2f} секунд")
+    logger.info("=" * 40)
+    
+    if result['updated'] == 0:
+        logger.info("Нет обновлений для выполнения")
+    
+    return result
+
 def main():
     """Основная функция"""
+    arg_parser = argparse.ArgumentParser(description="Обновление курсов валют в базе данных Notion")
+    arg_parser.add_argument(
+        "--once",
+        action="store_true",
+        help="выполнить одно обновление и завершиться (для cron/systemd timer)"
+    )
+    args = arg_parser.parse_args()
+    run_once = args.once or CONFIG.run_mode == "oneshot"
+    
     logger.info("=" * 60)
     logger.info("Запуск ОПТИМИЗИРОВАННОГО обновления курсов валют")
-    logger.info(f"База данных: {DATABASE_ID}")
-    logger.info(f"Частота обновления: каждые {UPDATE_FREQUENCY} час(а/ов)")
+    logger.info(f"База данных: {CONFIG.database_id}")
+    if run_once:
+        logger.info("Режим: однократный запуск")
+    else:
+        logger.info(f"Частота обновления: каждые {CONFIG.update_frequency} час(а/ов)")
+    logger.info(f"Потоков обновления: {CONFIG.notion_max_workers}, лимит Notion: {CONFIG.notion_rate_limit} запр/с")
     logger.info("Алгоритм: сбор уникальных валют → пачка курсов → массовое обновление")
     logger.info("=" * 60)
     
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    
     updater = OptimizedNotionUpdater()
+    atexit.register(updater.close)
     
-    while True:
+    if run_once:
+        # Расписанием и перезапусками управляет внешний планировщик
+        # Ненулевой код завершения нужен, чтобы планировщик увидел неудачный запуск
         try:
-            start_time = time.time()
-            
-            # Запускаем оптимизированную обработку
-            result = updater.process_database_optimized()
-            
-            execution_time = time.time() - start_time
-            
-            # Логируем результаты
-            logger.info("=" * 40)
-            logger.info("РЕЗУЛЬТАТЫ ОБРАБОТКИ:")
-            logger.info(f"  Уникальных валют: {result['unique_currencies']}")
-            logger.info(f"  Обновлено записей: {result['updated']}")
-            logger.info(f"  Пропущено записей: {result['skipped']}")
-            logger.info(f"  Ошибок: {result['errors']}")
-            logger.info(f"  Сэкономлено запросов к API: {result['api_calls_saved']}")
-            logger.info(f"  Время выполнения: {execution_time:.2f} секунд")
-            logger.info("=" * 40)
-            
-            if result['updated'] == 0:
-                logger.info("Нет обновлений для выполнения")
-            
-            # Ждем указанное время до следующего обновления
-            wait_time = UPDATE_FREQUENCY * 3600
-            logger.info(f"Следующее обновление через {UPDATE_FREQUENCY} час(а/ов)")
-            
-            time.sleep(wait_time)
-            
-        except KeyboardInterrupt:
-            logger.info("Получен сигнал прерывания. Завершение работы.")
-            break
+            result = run_update(updater)
+        except Exception as e:
+            logger.error(f"Критическая ошибка: {e}")
+            sys.exit(1)
+        sys.exit(1 if result["errors"] or result["query_failed"] else 0)
+    
+    period = CONFIG.update_frequency * 3600
+    scheduler = sched.scheduler(time.monotonic, time.sleep)
+    
+    def tick(deadline: float):
+        """Один запуск по расписанию и постановка следующего"""
+        try:
+            run_update(updater)
         except Exception as e:
             logger.error(f"Критическая ошибка: {e}")
             logger.info("Повтор через 5 минут")
-            time.sleep(300)
+            retry_at = time.monotonic() + 300
+            scheduler.enterabs(retry_at, 1, tick, (retry_at,))
+            return
+        
+        # Следующий запуск отсчитывается от предыдущего дедлайна, а не от
+        # конца обработки, поэтому расписание не дрейфует. Слоты, прошедшие
+        # за время обработки, пропускаются
+        next_run = deadline + period
+        while next_run <= time.monotonic():
+            next_run += period
+        
+        logger.info(f"Следующее обновление через {(next_run - time.monotonic()) / 3600:.2f} ч")
+        scheduler.enterabs(next_run, 1, tick, (next_run,))
+    
+    first_run = time.monotonic()
+    scheduler.enterabs(first_run, 1, tick, (first_run,))
+    
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logger.info("Получен сигнал прерывания. Завершение работы.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file